@@ -1,4 +1,6 @@
 import datetime
+import glob
+import os
 import pandas as pd
 import math
 import matplotlib.dates as mdates
@@ -17,6 +19,112 @@ def colorpicker(x):
     if x == 'tmpf':
         return 'red'
 
+# finds the intervals to shade for a weather type, where mask flags the observations reporting it
+# (each observation covers the time until the next one); consecutive observations are joined into
+# one span so a long event isn't shaded with one span per observation
+def weatherSpans(times,mask):
+    m = np.asarray(mask,dtype=bool)[:-1]
+    edges = np.diff(np.concatenate([[0],m.astype(int),[0]]))
+    starts = np.where(edges == 1)[0]
+    ends = np.where(edges == -1)[0]
+    return [[times[i],times[j]] for i,j in zip(starts,ends)]
+
+# picks at most one row per time bin (nbins equal bins between tmin and tmax) from the candidate
+# rows, so the picks are evenly spread in time no matter how the observations are spaced
+def thinByTime(times,rows,tmin,tmax,nbins):
+    if len(rows) == 0:
+        return rows
+    t = np.asarray(times[rows],dtype='int64').astype(float)
+    span = max(float(tmax - tmin),1.0)
+    bins = ((t - float(tmin)) / span * nbins).astype(int).clip(0,max(nbins-1,0))
+    return rows[np.unique(bins,return_index=True)[1]]
+
+# decimates a trace (x must be sorted) to the first, minimum, and maximum point in each of nbuckets
+# equal-width bins of x (plus the last point), so the reduced trace keeps the same envelope and exact
+# extremes
+def minmaxDecimate(x,y,nbuckets):
+    if len(x) <= 4 * nbuckets:
+        return np.arange(len(x))
+    x = np.asarray(x,dtype=float)
+    bins = ((x - x[0]) / (x[-1] - x[0]) * nbuckets).astype(int).clip(0,nbuckets-1)
+    groups = pd.Series(np.asarray(y)).groupby(bins)
+    idx = np.concatenate([groups.idxmin().values,groups.idxmax().values,\
+        np.searchsorted(bins,np.unique(bins)),[len(x)-1]])
+    return np.unique(idx)
+
+# column types in the IEM archive CSV (the raw metar column is never read)
+# precipitation and ice accretion are kept as strings since they use 'T' for trace amounts
+ARCHIVE_FLOATS = ['tmpf','dwpf','relh','drct','sknt','alti','mslp','vsby','gust','skyl1','skyl2','skyl3',\
+    'skyl4','peak_wind_gust','peak_wind_drct','feel']
+ARCHIVE_STRINGS = ['station','valid','p01i','skyc1','skyc2','skyc3','skyc4','wxcodes','ice_accretion_1hr',\
+    'ice_accretion_3hr','ice_accretion_6hr','peak_wind_time']
+ARCHIVE_DTYPES = dict([(c,'float32') for c in ARCHIVE_FLOATS] + [(c,str) for c in ARCHIVE_STRINGS])
+
+# reads the archive CSV a chunk at a time (columns: list of columns to read, or None for all but metar)
+def archiveChunks(datafile,columns=None,chunksize=100000):
+    usecols = columns if columns is not None else (lambda c: c != 'metar')
+    for chunk in pd.read_csv(datafile,usecols=usecols,dtype=ARCHIVE_DTYPES,chunksize=chunksize):
+        chunk['valid'] = pd.to_datetime(chunk['valid'],format='%Y-%m-%d %H:%M')
+        yield chunk
+
+# keeps only the observations for a station between the start and end times (None for no limit)
+def filterObs(df,station=None,start=None,end=None):
+    if station is not None:
+        df = df[df['station'] == station]
+    if start is not None:
+        df = df[df['valid'] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df['valid'] <= pd.Timestamp(end)]
+    return df
+
+# streams the archive CSV, keeping only the needed columns, station, and time window
+def readArchive(datafile,columns,station=None,start=None,end=None,chunksize=100000):
+    chunks = [filterObs(chunk,station,start,end) for chunk in archiveChunks(datafile,columns,chunksize)]
+    df = pd.concat(chunks,ignore_index=True)
+    return df.sort_values('valid').reset_index(drop=True)
+
+# converts the archive CSV into a Parquet cache partitioned by station and month
+# (cachedir/station=XXX/month=YYYY-MM/[csv name]-NNNNN.parquet), so several CSVs can share one cache
+def buildCache(datafile,cachedir,chunksize=100000):
+    name = os.path.splitext(os.path.basename(datafile))[0]
+    # clear out anything cached from an earlier version of this CSV
+    for f in glob.glob(os.path.join(cachedir,'station=*','month=*','%s-*.parquet' % name)):
+        os.remove(f)
+    for n,chunk in enumerate(archiveChunks(datafile,chunksize=chunksize)):
+        months = chunk['valid'].dt.strftime('%Y-%m')
+        for (stn,month),part in chunk.groupby([chunk['station'],months]):
+            partdir = os.path.join(cachedir,'station=%s' % stn,'month=%s' % month)
+            os.makedirs(partdir,exist_ok=True)
+            part.to_parquet(os.path.join(partdir,'%s-%05d.parquet' % (name,n)),engine='pyarrow',index=False)
+
+# checks whether the CSV needs to be (re)loaded into the cache: it has never been cached, or it has
+# been changed (e.g. re-downloaded with more data) since it was
+def cacheStale(datafile,cachedir):
+    name = os.path.splitext(os.path.basename(datafile))[0]
+    files = glob.glob(os.path.join(cachedir,'station=*','month=*','%s-*.parquet' % name))
+    return not files or os.path.getmtime(datafile) > min([os.path.getmtime(f) for f in files])
+
+# reads the needed columns for a station and time window from the Parquet cache, only opening the
+# months that overlap the time window
+# the cache can hold several CSVs, so with no station given only the rows from datafile are read; with a
+# station given, its rows from every cached CSV are used (overlapping downloads are only counted once)
+def readCache(datafile,cachedir,columns,station,start=None,end=None):
+    name = os.path.splitext(os.path.basename(datafile))[0]
+    pattern = '*.parquet' if station else '%s-*.parquet' % name
+    files = []
+    for partdir in sorted(glob.glob(os.path.join(cachedir,'station=%s' % (station or '*'),'month=*'))):
+        month = partdir.split('month=')[-1]
+        if start is not None and month < pd.Timestamp(start).strftime('%Y-%m'):
+            continue
+        if end is not None and month > pd.Timestamp(end).strftime('%Y-%m'):
+            continue
+        files += sorted(glob.glob(os.path.join(partdir,pattern)))
+    if not files:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat([pd.read_parquet(f,engine='pyarrow',columns=columns) for f in files],ignore_index=True)
+    df = filterObs(df,start=start,end=end).drop_duplicates(['station','valid'])
+    return df.sort_values('valid').reset_index(drop=True)
+
 # user settings
 datafile = 'dfw.csv'                        # CSV from IEM METAR archive
 outfile = 'dfw.png'                         # outfile path
@@ -24,12 +132,32 @@ primary_field = 'tmpf'                      # main field to plot on y-axis of fi
 primary_label = 'Temperature'               # label for primary field
 wind_on = True                              # plot wind barbs?
 mintemp = True                              # plot minimum temperature?
-barb_spacing = 1                            # spacing between wind barbs
+barb_spacing = 1                            # spacing between wind barbs in rows (ignored if lod is True)
+lod = True                                  # reduce the trace/barbs to what the image width can show?
+barb_px = 30                                # minimum pixels between wind barbs when lod is True
+station = None                              # station to plot (e.g. 'DFW', None to use every row in the CSV)
+start = None                                # start of time window (e.g. '2021-02-10 00:00', None for all)
+end = None                                  # end of time window (e.g. '2021-02-20 00:00', None for all)
+chunksize = 100000                          # number of CSV rows read at a time
+cachedir = None                             # Parquet cache directory (None to read the CSV directly)
+rebuild_cache = False                       # force reloading the CSV into the cache? (also done if it's newer)
 
 titlestr = 'Temperature at Dallas/Fort Worth International Airport (KDFW)'
 
-# import the surface observation file
-df = pd.read_csv(datafile)
+# import the surface observation file (only the columns that are plotted)
+columns = ['station','valid',primary_field,'wxcodes']
+if wind_on:
+    columns += ['sknt','drct']
+if cachedir is not None:
+    # load the CSV into the cache the first time it is used or whenever it has changed
+    if rebuild_cache or cacheStale(datafile,cachedir):
+        buildCache(datafile,cachedir,chunksize)
+    df = readCache(datafile,cachedir,columns,station,start,end)
+else:
+    df = readArchive(datafile,columns,station,start,end,chunksize)
+if not np.isfinite(df[primary_field].astype(float)).any():
+    raise ValueError("No %s observations found in %s for station %s between %s and %s." \
+        % (primary_field,datafile,station,start,end))
 
 # convert stuff to floats
 df[primary_field] = df[primary_field].astype(float)
@@ -50,16 +178,41 @@ plt.clf()
 fig = plt.figure(figsize=(24,16))
 ax = fig.add_subplot(1,1,1)
 
-plt.plot(df['valid'][primary_mask],df[primary_field][primary_mask],color=colorpicker(primary_field)\
-    ,label=primary_label,marker='o')
+# level of detail: size everything to the width of the plot in pixels so long archives don't draw
+# thousands of overlapping markers and barbs
+trace_x = df['valid'][primary_mask].reset_index(drop=True)
+trace_y = df[primary_field][primary_mask].reset_index(drop=True)
+marker = 'o'
+if lod:
+    dpi = plt.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = fig.dpi
+    width_px = ax.get_position().width * fig.get_figwidth() * dpi
+    # one bin per pixel column keeps the extremes (including the annotated minimum) exact
+    keep = minmaxDecimate(trace_x.values.astype('int64'),trace_y.values,int(width_px))
+    trace_x = trace_x[keep]
+    trace_y = trace_y[keep]
+    # markers only help when they don't run together
+    if len(trace_x) > width_px / 10.0:
+        marker = None
+
+plt.plot(trace_x,trace_y,color=colorpicker(primary_field),label=primary_label,marker=marker)
 if wind_on:
     '''
     plt.barbs(df['valid'][::barb_spacing],\
         (np.ones(df[primary_field].shape)*(y_lower + y_upper)/2)[::barb_spacing],u[::barb_spacing],\
         v[::barb_spacing])
     '''
-    plt.barbs(df['valid'][::barb_spacing],df[primary_field][::barb_spacing],u[::barb_spacing],\
-        v[::barb_spacing])
+    if lod:
+        # barbs can only be drawn where there is both a wind and a value to hang them on, and they are
+        # spread out by time (about barb_px pixels apart) rather than by row
+        barb_rows = np.where(primary_mask.values & np.isfinite(df['sknt'].values) \
+            & np.isfinite(df['drct'].values))[0]
+        times = df['valid'].values.astype('int64')
+        barb_rows = thinByTime(times,barb_rows,times.min(),times.max(),int(width_px / barb_px))
+    else:
+        barb_rows = np.arange(0,len(df),barb_spacing)
+    plt.barbs(df['valid'].values[barb_rows],df[primary_field].values[barb_rows],u[barb_rows],v[barb_rows])
 
 # plot aesthetics
 plt.grid()
@@ -67,7 +220,17 @@ plt.grid()
 # x-axis
 plt.xticks(rotation=90)
 plt.xlabel('Date/Time (UTC)')
-ax.xaxis.set_major_locator(mdates.HourLocator((0,6,12,18)))
+# every 6 hours, or (with lod) the shortest interval of 6 hours doubled that leaves room for the
+# labels, since thousands of tick labels on a long archive are slow to draw and unreadable anyway
+tick_hours = 6
+if lod:
+    span_hours = (df['valid'].max() - df['valid'].min()).total_seconds() / 3600.0
+    while span_hours / tick_hours > width_px / 30.0:
+        tick_hours *= 2
+if tick_hours < 24:
+    ax.xaxis.set_major_locator(mdates.HourLocator(range(0,24,tick_hours)))
+else:
+    ax.xaxis.set_major_locator(mdates.DayLocator(interval=tick_hours//24))
 ax.xaxis.set_major_formatter(mdates.DateFormatter('%a %d/%H'))
 plt.xlim([df['valid'].min(),df['valid'].max()])
 ax.hlines(y=32,xmin=df['valid'].min(),xmax=df['valid'].max(),linewidth=2,color='blue')
@@ -83,32 +246,23 @@ plt.ylabel('Temperature ($^\circ$F)',fontsize=18)
 ax.tick_params(axis='both',which='major',labelsize=14)
 
 # shade areas based on present weather
-fzra = []
-ra = []
-sn = []
-fzfg = []
-up = []
-
-# find the intervals for each weather type
-for i in range(len(df['wxcodes'])):
-    try:
-        # snow
-        if 'SN' in df['wxcodes'][i]:
-            sn.append([df['valid'][i],df['valid'][i+1]])
-        # freezing rain
-        elif 'FZRA' in df['wxcodes'][i]:
-            fzra.append([df['valid'][i],df['valid'][i+1]])
-        # rain
-        elif 'ra' in df['wxcodes'][i] and 'FZ' not in df['wxcodes'][i]:
-            ra.append([df['valid'][i],df['valid'][i+1]])
-        # freezing fog or freezing drizzle
-        elif 'FZFG' in df['wxcodes'][i] or 'FZDZ' in df['wxcodes'][i]:
-            fzfg.append([df['valid'][i],df['valid'][i+1]])
-        # unknown precipitation or sleet
-        elif 'UP' in df['wxcodes'][i] or 'PL' in df['wxcodes'][i]:
-            up.append([df['valid'][i],df['valid'][i+1]])
-    except TypeError:
-        continue
+wxcodes = df['wxcodes']
+def wxHas(code):
+    return wxcodes.str.contains(code,regex=False).fillna(False).values.astype(bool)
+
+# find the intervals for each weather type (checked in this order, so each observation only
+# counts toward the first type that matches)
+is_sn = wxHas('SN')                                                         # snow
+is_fzra = ~is_sn & wxHas('FZRA')                                            # freezing rain
+is_ra = ~is_sn & ~is_fzra & wxHas('ra') & ~wxHas('FZ')                      # rain
+is_fzfg = ~is_sn & ~is_fzra & ~is_ra & (wxHas('FZFG') | wxHas('FZDZ'))      # freezing fog/drizzle
+is_up = ~is_sn & ~is_fzra & ~is_ra & ~is_fzfg & (wxHas('UP') | wxHas('PL')) # unknown precip or sleet
+valid = df['valid'].tolist()
+sn = weatherSpans(valid,is_sn)
+fzra = weatherSpans(valid,is_fzra)
+ra = weatherSpans(valid,is_ra)
+fzfg = weatherSpans(valid,is_fzfg)
+up = weatherSpans(valid,is_up)
 
 # color in the areas
 for ix,j in enumerate(fzra):
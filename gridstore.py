@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+''' Saves the objective analysis grids created in objective.py to a chunked, compressed Zarr store
+    so they can be reused without redoing the Cressman analysis. Each domain gets its own store and
+    every cycle is appended along the time dimension, so earlier cycles are never rewritten and
+    tendencies (e.g. 3-hour pressure change) are just a difference of two time slices.
+
+    Packages used: numpy, pandas, xarray, zarr
+
+    Version History:
+    1.0 - Initial build.
+'''
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+import zarr
+
+__author__ = 'Jason Godwin'
+__license__ = 'GPL'
+__version__ = '1.0'
+__maintainer__ = 'Jason Godwin'
+__email__ = 'jasonwgodwin@gmail.com'
+__status__ = 'PRODUCTION'
+
+# converts the valid time string from dataformatter.py (e.g. 2020-01-06 12:00:00Z) to a naive UTC time
+def validTime(vt):
+    return pd.to_datetime(vt.strip(),utc=True).tz_convert(None)
+
+# builds the CF grid mapping attributes for the Lambert Conformal projection used in objective.py
+def gridMapping(proj):
+    params = proj.proj4_params
+    parallels = [params[k] for k in ('lat_1','lat_2') if k in params]
+    return {'grid_mapping_name':'lambert_conformal_conic',
+            'standard_parallel':parallels,
+            'longitude_of_central_meridian':params['lon_0'],
+            'latitude_of_projection_origin':params['lat_0'],
+            'false_easting':params.get('x_0',0.0),
+            'false_northing':params.get('y_0',0.0),
+            'proj4':proj.proj4_init}
+
+# fills masked grid points with NaN and adds a leading time axis
+def prepGrid(grid):
+    return np.ma.filled(np.ma.masked_invalid(np.asarray(grid,dtype='float32')),np.nan)[np.newaxis,...]
+
+# checks whether a store was written on the same grid as the new cycle
+def sameGrid(store,coords):
+    for name in ('x','y','xc','yc'):
+        old = store[name].values
+        new = np.asarray(coords[name][1])
+        if old.shape != new.shape or not np.allclose(old,new):
+            return False
+    return True
+
+# writes one cycle of analysis grids to the store at storepath
+# fine: {name:(grid,units)} on the analysis grid (finex,finey)
+# coarse: {name:(grid,units)} on the pressure/wind grid (coarsex,coarsey)
+# saving the grids is an add-on, so a failure is printed rather than stopping the maps from being made
+def writeGrids(storepath,vt,proj,finex,finey,fine,coarsex,coarsey,coarse):
+    try:
+        saveCycle(storepath,vt,proj,finex,finey,fine,coarsex,coarsey,coarse)
+    except Exception as e:
+        print("Could not save grids valid %s to %s: %s" % (vt.strip(),storepath,e))
+
+def saveCycle(storepath,vt,proj,finex,finey,fine,coarsex,coarsey,coarse):
+    time = validTime(vt)
+
+    variables = {}
+    for name,(grid,unit) in fine.items():
+        variables[name] = (('time','y','x'),prepGrid(grid),{'units':unit,'grid_mapping':'crs'})
+    for name,(grid,unit) in coarse.items():
+        variables[name] = (('time','yc','xc'),prepGrid(grid),{'units':unit,'grid_mapping':'crs'})
+    variables['crs'] = ((),np.int32(0),gridMapping(proj))
+    coords = {'time':[time],
+              'x':('x',finex[0,:],{'units':'m','standard_name':'projection_x_coordinate'}),
+              'y':('y',finey[:,0],{'units':'m','standard_name':'projection_y_coordinate'}),
+              'xc':('xc',coarsex[0,:],{'units':'m','standard_name':'projection_x_coordinate'}),
+              'yc':('yc',coarsey[:,0],{'units':'m','standard_name':'projection_y_coordinate'})}
+    ds = xr.Dataset(variables,coords=coords)
+
+    append = os.path.isdir(storepath)
+    if append:
+        store = xr.open_zarr(storepath)
+        # skip cycles that are already in the store (e.g. the script was rerun for the same hour)
+        if time.to_datetime64() in store['time'].values:
+            print("Grids valid %s already saved." % vt.strip())
+            return
+        # the domain or resolution changed (e.g. the floater moved), so the old cycles can't be stacked
+        # with the new ones: move the old store aside (named by its last cycle) and start a new one
+        if not sameGrid(store,coords):
+            last = pd.Timestamp(store['time'].values[-1]).strftime('%Y%m%d%H%M')
+            oldpath = '%s_%s%s' % (os.path.splitext(storepath)[0],last,os.path.splitext(storepath)[1])
+            store.close()
+            os.rename(storepath,oldpath)
+            print("Grid changed, moved the old grids to %s and starting a new store." % oldpath)
+            append = False
+
+    if append:
+        # the projection variable has no time dimension, so it is only written with the first cycle
+        ds.drop('crs').to_zarr(storepath,append_dim='time')
+    else:
+        # one chunk per cycle so appending only ever writes new chunks
+        compressor = zarr.Blosc(cname='zstd',clevel=3,shuffle=zarr.Blosc.BITSHUFFLE)
+        encoding = {'time':{'units':'hours since 1970-01-01 00:00:00','dtype':'float64'}}
+        for name in ds.data_vars:
+            if name != 'crs':
+                encoding[name] = {'chunks':(1,) + ds[name].shape[1:],'compressor':compressor}
+        ds.to_zarr(storepath,mode='w',encoding=encoding)
+
+# returns the change in a variable over the previous number of hours ending at vt
+# (None if either cycle is missing from the store)
+def tendency(storepath,variable,vt,hours=3):
+    ds = xr.open_zarr(storepath)
+    end = validTime(vt)
+    start = end - pd.Timedelta(hours=hours)
+    times = ds['time'].values
+    if end.to_datetime64() not in times or start.to_datetime64() not in times:
+        return None
+    return (ds[variable].sel(time=end) - ds[variable].sel(time=start)).load()
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+''' Builds animated loops from the images created by stationplots2.py and objective.py. The last N
+    frames of each product are kept in a ring buffer on disk (loopdir/[product]/), so each cycle only
+    the newest frame is processed and the oldest is thrown out; past hours are never re-rendered.
+
+    All of the per-frame work is cached with each frame: the frame is resized and PNG-compressed
+    once, the GIF frame is quantized and LZW-encoded once, and the MP4 frame is encoded once with
+    ffmpeg as its own one-frame segment. Rebuilding the loop is then just splicing the cached GIF
+    image blocks or PNG image data (for APNG) together between a new header and trailer, and
+    stream-copying (no re-encoding) the MP4 segments together.
+
+    Packages used: Pillow, ffmpeg (command line, for MP4 loops)
+
+    Version History:
+    1.0 - Initial build.
+'''
+import datetime
+import json
+import os
+import io
+import shutil
+import struct
+import subprocess
+import zlib
+
+from PIL import Image
+
+__author__ = 'Jason Godwin'
+__license__ = 'GPL'
+__version__ = '1.0'
+__maintainer__ = 'Jason Godwin'
+__email__ = 'jasonwgodwin@gmail.com'
+__status__ = 'PRODUCTION'
+
+def loadIndex(framedir):
+    try:
+        with open(os.path.join(framedir,'index.json')) as f:
+            return json.load(f)
+    except (IOError,ValueError):
+        return []
+
+def saveIndex(framedir,index):
+    with open(os.path.join(framedir,'index.json'),'w') as f:
+        json.dump(index,f)
+
+# removes the cached files for a frame
+def removeFrame(framedir,stamp):
+    for ext in ('png','gifblock','mp4'):
+        path = os.path.join(framedir,'%s.%s' % (stamp,ext))
+        if os.path.exists(path):
+            os.remove(path)
+
+# resizes a frame to the loop width (keeping the dimensions even, which the MP4 encoder needs)
+# if size is given the frame is resized to exactly that size, since all the frames in a loop must match
+# (the images are saved with bbox_inches='tight', so they can be off by a few pixels)
+def resizeFrame(imagepath,width,size=None):
+    img = Image.open(imagepath).convert('RGB')
+    if size is None:
+        width = min(width,img.width) // 2 * 2
+        size = (width,int(round(img.height * width / img.width)) // 2 * 2)
+    return img.resize(size,Image.LANCZOS)
+
+# runs ffmpeg, returning False (after printing the error) if it fails
+# loops are an add-on, so an ffmpeg problem shouldn't stop the maps from being made
+def runFfmpeg(args,outfile):
+    try:
+        subprocess.run(['ffmpeg','-y','-loglevel','error'] + args + [outfile],check=True,\
+            stderr=subprocess.PIPE)
+        return True
+    except (subprocess.CalledProcessError,OSError) as e:
+        stderr = getattr(e,'stderr',None)
+        print("ffmpeg failed for %s: %s" % (outfile,stderr.decode(errors='replace').strip() if stderr else e))
+        # don't leave a partial file behind to be mistaken for a good one
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        return False
+
+# encodes one frame as a single-frame MP4 segment
+def encodeSegment(pngpath,segpath,delay):
+    return runFfmpeg(['-framerate','%.3f' % (1000.0/delay),'-i',pngpath,'-frames:v','1','-c:v','libx264',\
+        '-pix_fmt','yuv420p'],segpath)
+
+# skips over GIF data sub-blocks starting at pos, returning the position after the terminator
+def skipSubBlocks(data,pos):
+    while data[pos] != 0:
+        pos += data[pos] + 1
+    return pos + 1
+
+# quantizes and encodes a frame once, caching just its GIF image block (image descriptor, color
+# table, and LZW data) so the loop can be put together later without encoding it again
+def encodeGifBlock(img,blockpath):
+    buf = io.BytesIO()
+    img.quantize(colors=256,method=Image.MEDIANCUT).save(buf,format='GIF')
+    data = buf.getvalue()
+    # the single-frame GIF keeps its palette in the global color table
+    packed = data[10]
+    pos = 13
+    table = b''
+    if packed & 0x80:
+        table = data[pos:pos + 3 * 2 ** ((packed & 0x07) + 1)]
+        pos += len(table)
+    # skip any extensions ahead of the image
+    while data[pos] == 0x21:
+        pos = skipSubBlocks(data,pos+2)
+    # image descriptor, with the palette moved into a local color table
+    desc = data[pos:pos+10]
+    imgpacked = desc[9]
+    pos += 10
+    if imgpacked & 0x80:
+        table = data[pos:pos + 3 * 2 ** ((imgpacked & 0x07) + 1)]
+        pos += len(table)
+        tablebits = imgpacked & 0x07
+    else:
+        tablebits = packed & 0x07
+    end = skipSubBlocks(data,pos+1)
+    with open(blockpath,'wb') as f:
+        f.write(desc[:9] + bytes([0x80 | (imgpacked & 0x40) | tablebits]) + table + data[pos:end])
+
+# writes the GIF loop by splicing the cached image blocks together (no re-encoding)
+def writeGif(framedir,index,outfile,delay):
+    blocks = []
+    for stamp in index:
+        with open(os.path.join(framedir,'%s.gifblock' % stamp),'rb') as f:
+            blocks.append(f.read())
+    width,height = struct.unpack('<HH',blocks[0][5:9])
+    # header, screen descriptor (no global color table), and loop forever
+    out = [b'GIF89a',struct.pack('<HHBBB',width,height,0x70,0,0),\
+        b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H',0) + b'\x00']
+    for n,block in enumerate(blocks):
+        # hold the last frame a little longer so it is obvious where the loop ends
+        frame_delay = delay * 3 if n == len(blocks) - 1 else delay
+        # graphic control extension with the frame delay (in hundredths of a second)
+        out.append(b'\x21\xf9\x04' + struct.pack('<BHB',0x04,int(round(frame_delay / 10.0)),0) + b'\x00')
+        out.append(block)
+    out.append(b'\x3b')
+    tmpfile = outfile + '.tmp'
+    with open(tmpfile,'wb') as f:
+        f.write(b''.join(out))
+    # swap the new loop in all at once so the web server never serves a partial file
+    os.replace(tmpfile,outfile)
+
+# splits PNG data into (type,body) chunks
+def pngChunks(data):
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        length, = struct.unpack('>I',data[pos:pos+4])
+        chunks.append((data[pos+4:pos+8],data[pos+8:pos+8+length]))
+        pos += length + 12
+    return chunks
+
+# builds a PNG chunk
+def pngChunk(ctype,body):
+    return struct.pack('>I',len(body)) + ctype + body + struct.pack('>I',zlib.crc32(ctype + body) & 0xffffffff)
+
+# writes the APNG loop by splicing the compressed image data of the cached PNG frames (no re-encoding)
+def writeApng(framedir,index,outfile,delay):
+    out = [b'\x89PNG\r\n\x1a\n']
+    seq = 0
+    for n,stamp in enumerate(index):
+        with open(os.path.join(framedir,'%s.png' % stamp),'rb') as f:
+            chunks = pngChunks(f.read())
+        if n == 0:
+            ihdr = [body for ctype,body in chunks if ctype == b'IHDR'][0]
+            width,height = struct.unpack('>II',ihdr[:8])
+            out.append(pngChunk(b'IHDR',ihdr))
+            # animation control: number of frames, loop forever
+            out.append(pngChunk(b'acTL',struct.pack('>II',len(index),0)))
+        # hold the last frame a little longer so it is obvious where the loop ends
+        frame_delay = delay * 3 if n == len(index) - 1 else delay
+        # frame control: full-frame, delay in milliseconds
+        out.append(pngChunk(b'fcTL',struct.pack('>IIIIIHHBB',seq,width,height,0,0,frame_delay,1000,0,0)))
+        seq += 1
+        idat = b''.join([body for ctype,body in chunks if ctype == b'IDAT'])
+        # the first frame is the regular PNG image, the rest are frame data chunks
+        if n == 0:
+            out.append(pngChunk(b'IDAT',idat))
+        else:
+            out.append(pngChunk(b'fdAT',struct.pack('>I',seq) + idat))
+            seq += 1
+    out.append(pngChunk(b'IEND',b''))
+    tmpfile = outfile + '.tmp'
+    with open(tmpfile,'wb') as f:
+        f.write(b''.join(out))
+    os.replace(tmpfile,outfile)
+
+# writes the MP4 loop by stream-copying the cached segments (no re-encoding)
+def writeMp4(framedir,index,outfile,delay):
+    listfile = os.path.join(framedir,'segments.txt')
+    with open(listfile,'w') as f:
+        for n,stamp in enumerate(index):
+            # hold the last frame a little longer, as in the GIF and APNG loops
+            frame_delay = delay * 3 if n == len(index) - 1 else delay
+            f.write("file '%s.mp4'\nduration %.3f\n" % (stamp,frame_delay/1000.0))
+    tmpfile = outfile + '.tmp.mp4'
+    if runFfmpeg(['-f','concat','-safe','0','-i',listfile,'-c','copy','-movflags','+faststart'],tmpfile):
+        os.replace(tmpfile,outfile)
+
+# adds a newly rendered image to a product's loop and rebuilds the loop files
+# loopdir: working directory for the frame buffers
+# product: product name (e.g. conus_temp), used for the buffer directory and output filenames
+# imagepath: path to the image just rendered
+# vt: valid time string from dataformatter.py (e.g. 2020-01-06 12:00:00Z)
+# nframes: number of frames to keep in the loop
+# formats: loop formats to create ('gif', 'apng', and/or 'mp4')
+# outdir: directory for the finished loops (named [product]_loop.gif/.png/.mp4)
+# width: width of the loop frames (pixels)
+# delay: time each frame is shown (milliseconds)
+def addFrame(loopdir,product,imagepath,vt,nframes=24,formats=('gif','mp4'),outdir=None,width=1280,\
+    delay=500):
+    framedir = os.path.join(loopdir,product)
+    os.makedirs(framedir,exist_ok=True)
+    if outdir is None:
+        outdir = loopdir
+    if 'mp4' in formats and shutil.which('ffmpeg') is None:
+        print("ffmpeg not found, skipping MP4 loop for %s." % product)
+        formats = [fmt for fmt in formats if fmt != 'mp4']
+
+    # frames are named by valid time so they sort in order
+    stamp = datetime.datetime.strptime(vt.strip(),'%Y-%m-%d %H:%M:00Z').strftime('%Y%m%d%H%M')
+
+    # cache the new frame (a rerun for the same time replaces that frame)
+    index = loadIndex(framedir)
+    # drop any frames whose cached image has gone missing (e.g. the buffer was partly cleaned out)
+    for old in index:
+        if not os.path.exists(os.path.join(framedir,'%s.png' % old)):
+            removeFrame(framedir,old)
+    index = [old for old in index if os.path.exists(os.path.join(framedir,'%s.png' % old))]
+    size = Image.open(os.path.join(framedir,'%s.png' % index[-1])).size if index else None
+    img = resizeFrame(imagepath,width,size)
+    pngpath = os.path.join(framedir,'%s.png' % stamp)
+    img.save(pngpath)
+    if 'gif' in formats:
+        encodeGifBlock(img,os.path.join(framedir,'%s.gifblock' % stamp))
+    # the MP4 loop is skipped this cycle if a segment can't be encoded (missing segments are retried
+    # below on the next cycle)
+    mp4ok = True
+    if 'mp4' in formats:
+        mp4ok = encodeSegment(pngpath,os.path.join(framedir,'%s.mp4' % stamp),delay)
+
+    # add the frame to the ring buffer and evict the oldest frames
+    index = sorted(set(index) | {stamp})
+    while len(index) > nframes:
+        removeFrame(framedir,index.pop(0))
+    saveIndex(framedir,index)
+
+    # frames cached before a format was turned on are missing that format, so fill them in
+    for old in index:
+        oldpng = os.path.join(framedir,'%s.png' % old)
+        if 'gif' in formats and not os.path.exists(os.path.join(framedir,'%s.gifblock' % old)):
+            encodeGifBlock(Image.open(oldpng).convert('RGB'),os.path.join(framedir,'%s.gifblock' % old))
+        if 'mp4' in formats and mp4ok and not os.path.exists(os.path.join(framedir,'%s.mp4' % old)):
+            mp4ok = encodeSegment(oldpng,os.path.join(framedir,'%s.mp4' % old),delay)
+
+    # rebuild the loops
+    if 'gif' in formats:
+        writeGif(framedir,index,os.path.join(outdir,'%s_loop.gif' % product),delay)
+    if 'apng' in formats:
+        writeApng(framedir,index,os.path.join(outdir,'%s_loop.png' % product),delay)
+    if 'mp4' in formats and mp4ok:
+        writeMp4(framedir,index,os.path.join(outdir,'%s_loop.mp4' % product),delay)
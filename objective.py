@@ -8,6 +8,10 @@
         1.10 - Now plots theta-e and mixing ratio (released 2020/01/06).
         1.11 - Changed projection to Lambert Conformal to be consistent with stationplots2.py.
                 Also added support for flipping the wind barbs in the Southern Hemisphere.
+        1.12 - Grids now cover a fixed area for each domain and are saved to a Zarr store (see
+                gridstore.py) so they can be reused and stacked in time.
+        1.13 - Added Web Mercator tile output (see tiles.py).
+        1.14 - Added animated loops (see loops.py).
 '''
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
@@ -19,16 +23,21 @@ from matplotlib.colors import BoundaryNorm
 
 from metpy.calc import wind_components,divergence,equivalent_potential_temperature
 from metpy.calc import relative_humidity_from_dewpoint,mixing_ratio_from_relative_humidity
-from metpy.calc import advection
+from metpy.calc import advection, reduce_point_density
 
 from metpy.cbook import get_test_data
 from metpy.interpolate import interpolate_to_grid, remove_nan_observations
 from metpy.plots import add_metpy_logo
 from metpy.units import units
 
+from gridstore import writeGrids
+from tiles import MERCATOR, dataHash, gridWindow, pixelsToMeters, pointsInTile, renderChanged, saveTile
+from tiles import tileBounds, tileFigure, tilesForExtent
+from loops import addFrame
+
 __author__ = 'Jason Godwin'
 __license__ = 'GPL'
-__version__ = '1.1'
+__version__ = '1.14'
 __maintainer__ = 'Jason Godwin'
 __email__ = 'jasonwgodwin@gmail.com'
 __status__ = 'PRODUCTION'
@@ -55,6 +64,61 @@ def mixingRatio(td,slp,z):
     p_station = stationPressure(slp,z)
     return e / (p_station - e)
 
+# computes the projected bounding box of a lat/lon box (used to keep the grids the same every cycle)
+def domainBounds(proj,west,east,south,north):
+    # sample along the edges since the parallels are curved in the Lambert Conformal projection
+    n = 50
+    lons = np.concatenate([np.linspace(west,east,n),np.full(n,east),np.linspace(east,west,n),np.full(n,west)])
+    lats = np.concatenate([np.full(n,south),np.linspace(south,north,n),np.full(n,north),np.linspace(north,south,n)])
+    pts = proj.transform_points(ccrs.Geodetic(),lons,lats)
+    return {'west':pts[:,0].min(),'east':pts[:,0].max(),'south':pts[:,1].min(),'north':pts[:,1].max()}
+
+# renders one analysis tile (run in the tile worker processes)
+def renderGridTile(path,bounds,proj,x,y,grid,levels,cmapname,sx,sy,slp,bx,by,bu,bv,flip):
+    fig,ax = tileFigure(bounds)
+    cmap = plt.get_cmap(cmapname)
+    norm = BoundaryNorm(levels, ncolors=cmap.N, clip=True)
+    ax.pcolormesh(x, y, grid, cmap=cmap, norm=norm, transform=proj)
+    # contour labels are left off since they would get cut off at the tile edges
+    if slp is not None and np.isfinite(slp).any():
+        ax.contour(sx, sy, slp, colors='k', levels=list(range(990, 1034, 4)), transform=proj)
+    if len(bx) > 0:
+        ax.barbs(bx, by, bu, bv, alpha=.4, length=5, flip_barb=flip, transform=proj)
+    saveTile(fig,path)
+
+# works out the part of the grids and the (thinned) wind barbs that go on each tile
+# this is the same for every variable, so it is done once per domain
+# (spacing is the minimum distance between wind barbs on the tiles in pixels)
+def tileLayout(zooms,spacing,extent,proj,x,y,sx,sy,wx,wy,uwind,vwind):
+    # grid locations in Web Mercator (the SLP and wind grids are the same)
+    fine = MERCATOR.transform_points(proj,x,y)
+    coarse = MERCATOR.transform_points(proj,sx,sy)
+    good = np.isfinite(uwind) & np.isfinite(vwind)
+    bx,by,bu,bv = wx[good],wy[good],uwind[good],vwind[good]
+    bmx,bmy = coarse[...,0][good],coarse[...,1][good]
+    layout = []
+    for zoom in zooms:
+        keep = reduce_point_density(np.column_stack([bmx,bmy]),pixelsToMeters(spacing,zoom))
+        for tile in tilesForExtent(*extent,zoom):
+            bounds = tileBounds(*tile)
+            fw = gridWindow(fine[...,0],fine[...,1],bounds)
+            cw = gridWindow(coarse[...,0],coarse[...,1],bounds)
+            inb = keep & pointsInTile(bmx,bmy,bounds)
+            layout.append((tile,bounds,fw,cw,(bx[inb],by[inb],bu[inb],bv[inb])))
+    return layout
+
+# renders the tiles for one analysis product from the layout made by tileLayout()
+def gridTiles(tiledir,layout,proj,x,y,grid,levels,cmapname,sx,sy,slp,flip,nprocs):
+    jobs = {}
+    for tile,bounds,fw,cw,barbs in layout:
+        if fw is None or (np.ma.count(grid[fw]) == 0 and len(barbs[0]) == 0):
+            jobs[tile] = (None,None)
+            continue
+        slpwin = (sx[cw],sy[cw],slp[cw]) if cw is not None else (None,None,None)
+        args = (bounds,proj,x[fw],y[fw],grid[fw],levels,cmapname) + slpwin + barbs + (flip,)
+        jobs[tile] = (dataHash(grid[fw],slpwin[2],*barbs,levels,cmapname,flip),args)
+    renderChanged(tiledir,jobs,renderGridTile,nprocs)
+
 def main():
     ### START OF USER SETTINGS BLOCK ###
     # FILE/DATA SETTINGS
@@ -77,6 +141,29 @@ def main():
     savedir = '/var/www/html/images/'
     # filenames ("_[variable].png" will be appended, so only a descriptor like "conus" is needed)
     savenames = ['conus','texas','floater1']
+    # save the analysis grids for reuse? (True/False)
+    savegrids = True
+    # directory for the grid stores ("_grids.zarr" will be appended to the savenames above)
+    griddir = '/home/jgodwin/python/sfc_observations/grids/'
+    # create the full-size maps? (True/False)
+    make_png = True
+    # create Web Mercator tiles? (True/False): tiles go in tiledir/[savename]_[variable]/z/x/y.png
+    make_tiles = False
+    tiledir = '/var/www/html/tiles/'
+    # zoom levels to create tiles for
+    tilezooms = [4,5,6,7]
+    # minimum distance allowed between wind barbs on the tiles (in pixels, converted for each zoom level)
+    tilespacing = 40.0
+    # number of processes used to render tiles
+    nprocs = 4
+    # products to make animated loops of ("[savename]_[variable]"): saved in savedir as [product]_loop.gif/.png/.mp4
+    loopproducts = ['conus_temp','conus_thte']
+    # working directory for the loop frames
+    loopdir = '/home/jgodwin/python/sfc_observations/loops/'
+    # number of frames (hours) in each loop
+    loopframes = 24
+    # loop formats ('gif', 'apng', and/or 'mp4', mp4 needs ffmpeg)
+    loopformats = ['gif','apng','mp4']
 
     # TEST MODE SETTINGS
     test = False
@@ -117,6 +204,8 @@ def main():
         lon = data['lon'].values
         lat = data['lat'].values
         xp, yp, _ = to_proj.transform_points(ccrs.Geodetic(), lon, lat).T
+        # grid over the same area as the data filter so every cycle uses the same grid
+        bounds = domainBounds(to_proj,west[i]-2.0,east[i]+2.0,south[i]-2.0,north[i]+2.0)
 
         # remove missing data from pressure and interpolate
         # we'll give this a try and see if it can help with my CPU credit problem
@@ -125,7 +214,7 @@ def main():
             x_masked, y_masked, pres = remove_nan_observations(xp, yp, data['slp'].values)
             slpgridx, slpgridy, slp = interpolate_to_grid(x_masked, y_masked, pres, interp_type='cressman',
                                                           minimum_neighbors=1, search_radius=400000,
-                                                          hres=100000)
+                                                          hres=100000, boundary_coords=bounds)
 
             # get wind information and remove missing data
             wind_speed = (data['wsp'].values * units('knots'))
@@ -138,28 +227,29 @@ def main():
             u, v = wind_components(wind_speed, wind_dir)
             windgridx, windgridy, uwind = interpolate_to_grid(x_masked, y_masked, np.array(u),
                                                               interp_type='cressman', search_radius=400000,
-                                                              hres=100000)
+                                                              hres=100000, boundary_coords=bounds)
             _, _, vwind = interpolate_to_grid(x_masked, y_masked, np.array(v), interp_type='cressman',
-                                              search_radius=400000, hres=100000)
+                                              search_radius=400000, hres=100000, boundary_coords=bounds)
 
             # get temperature information
             data['temp'] = cToF(data['temp'])
             x_masked, y_masked, t = remove_nan_observations(xp, yp, data['temp'].values)
             tempx, tempy, temp = interpolate_to_grid(x_masked, y_masked, t, interp_type='cressman',
-                                                     minimum_neighbors=3, search_radius=200000, hres=18000)
+                                                     minimum_neighbors=3, search_radius=200000, hres=18000,
+                                                     boundary_coords=bounds)
             temp = np.ma.masked_where(np.isnan(temp), temp)
 
             # get dewpoint information
             data['dpt'] = cToF(data['dpt'])
             x_masked,y_masked,td = remove_nan_observations(xp,yp,data['dpt'].values)
             dptx,dpty,dewp = interpolate_to_grid(x_masked,y_masked,td,interp_type='cressman',\
-                minimum_neighbors=3,search_radius=200000,hres=18000)
+                minimum_neighbors=3,search_radius=200000,hres=18000,boundary_coords=bounds)
             dewp = np.ma.masked_where(np.isnan(dewp),dewp)
 
             # interpolate wind speed
             x_masked,y_masked,wspd = remove_nan_observations(xp,yp,data['wsp'].values)
             wspx,wspy,speed = interpolate_to_grid(x_masked,y_masked,wspd,interp_type='cressman',\
-                minimum_neighbors=3,search_radius=200000,hres=18000)
+                minimum_neighbors=3,search_radius=200000,hres=18000,boundary_coords=bounds)
             speed = np.ma.masked_where(np.isnan(speed),speed)
 
             # derived values
@@ -169,7 +259,7 @@ def main():
             data['thetae'] = equivalent_potential_temperature(data['pres'].values*units.hPa,data['temp'].values*units.degF,data['dpt'].values*units.degF)
             x_masked,y_masked,thetae = remove_nan_observations(xp,yp,data['thetae'].values)
             thex,they,thte = interpolate_to_grid(x_masked,y_masked,thetae,interp_type='cressman',\
-                minimum_neighbors=3,search_radius=200000,hres=18000)
+                minimum_neighbors=3,search_radius=200000,hres=18000,boundary_coords=bounds)
             thte = np.ma.masked_where(np.isnan(thte),thte)
 
             # mixing ratio
@@ -177,9 +267,17 @@ def main():
             mixr = mixing_ratio_from_relative_humidity(relh,data['temp'].values*units.degF,data['pres'].values*units.hPa) * 1000.0
             x_masked,y_masked,mixrat = remove_nan_observations(xp,yp,mixr)
             mrx,mry,mrat = interpolate_to_grid(x_masked,y_masked,mixrat,interp_type='cressman',\
-                minimum_neighbors=3,search_radius=200000,hres=18000)
+                minimum_neighbors=3,search_radius=200000,hres=18000,boundary_coords=bounds)
             mrat = np.ma.masked_where(np.isnan(mrat),mrat)
 
+            # save the grids so they don't have to be recomputed later
+            if savegrids:
+                print("Saving grids.")
+                writeGrids('%s%s_grids.zarr' % (griddir,savenames[i]),vt,to_proj,tempx,tempy,\
+                    {'temp':(temp,'degF'),'dewp':(dewp,'degF'),'wspd':(speed,'knots'),'thte':(thte,'K'),\
+                    'mrat':(mrat,'g/kg')},slpgridx,slpgridy,{'slp':(slp,'hPa'),'u':(uwind,'knots'),\
+                    'v':(vwind,'knots')})
+
         # set up the state borders
         state_boundaries = cfeature.NaturalEarthFeature(category='cultural',\
             name='admin_1_states_provinces_lines',scale='50m',facecolor='none')
@@ -198,8 +296,19 @@ def main():
         # colormaps
         colormaps = ['hsv_r','Greens','plasma','hsv_r','Greens']
 
+        # the tile windows and wind barbs are the same for every variable
+        if make_tiles:
+            layout = tileLayout(tilezooms,tilespacing,(west[i],east[i],south[i],north[i]),to_proj,tempx,\
+                tempy,slpgridx,slpgridy,windgridx,windgridy,uwind,vwind)
+
         for j in range(len(variables)):
             print("\t%s" % variables[j])
+            if make_tiles:
+                gridTiles('%s%s_%s' % (tiledir,savenames[i],varplots[j]),layout,to_proj,tempx,tempy,\
+                    vardata[j],list(range(levs[j][0],levs[j][1],levs[j][2])),colormaps[j],slpgridx,slpgridy,\
+                    slp,flip,nprocs)
+            if not make_png:
+                continue
             fig = plt.figure(figsize=(20, 10))
             view = fig.add_subplot(1, 1, 1, projection=to_proj)
             
@@ -230,7 +339,13 @@ def main():
 
             # plot title and save
             view.set_title('%s (shaded), SLP, and Wind (valid %s)' % (variables[j],vt))
-            plt.savefig('/var/www/html/images/%s_%s.png' % (savenames[i],varplots[j]),bbox_inches='tight')
+            product = '%s_%s' % (savenames[i],varplots[j])
+            outfile_name = '/var/www/html/images/%s.png' % product
+            plt.savefig(outfile_name,bbox_inches='tight')
+            # add the new map to the loop
+            if product in loopproducts:
+                print("\tUpdating loop.")
+                addFrame(loopdir,product,outfile_name,vt,nframes=loopframes,formats=loopformats,outdir=savedir)
 
             # close everything
             fig.clear()
@@ -10,6 +10,8 @@
         2.11 - Displays warmest/coolest temperature and highest dewpoint on each map 
                 (also circles them). Released 2020/01/06.
         2.12 - Changes to the way the Lambert Conformal Map is setup.
+        2.13 - Added Web Mercator tile output (see tiles.py) with station thinning by zoom level.
+        2.14 - Added animated loops (see loops.py).
 '''
 
 import matplotlib
@@ -27,9 +29,13 @@ from metpy.calc import wind_components
 from metpy.plots import current_weather, sky_cover, StationPlot, wx_code_map
 from metpy.units import units
 
+from tiles import MERCATOR, dataHash, pixelsToMeters, pointsInTile, renderChanged, saveTile, tileBounds
+from tiles import tileFigure, tilesForExtent
+from loops import addFrame
+
 __author__ = 'Jason Godwin'
 __license__ = 'GPL'
-__version__ = '2.12'
+__version__ = '2.14'
 __maintainer__ = 'Jason Godwin'
 __email__ = 'jasonwgodwin@gmail.com'
 __status__ = 'PRODUCTION'
@@ -44,6 +50,50 @@ def icaoLookup(location,icaodf):
     except IndexError:
         return ''
 
+# plots the station models (data must already have the u/v, cloud, and wxcode columns)
+def plotStations(ax,data,flip,fontsize):
+    # lat/lon of the station plots
+    stationplot = StationPlot(ax,data['lon'].values,data['lat'].values,clip_on=True,\
+        transform=ccrs.PlateCarree(),fontsize=fontsize)
+    # plot the temperature and dewpoint
+    stationplot.plot_parameter('NW',data['temp'],color='red')
+    stationplot.plot_parameter('SW',data['dpt'],color='darkgreen')
+    # plot the SLP using the standard trailing three digits
+    stationplot.plot_parameter('NE',data['slp'],formatter=lambda v: format(10*v,'.0f')[-3:])
+    # plot the sky condition
+    stationplot.plot_symbol('C',data['cloud'].values,sky_cover)
+    # plot the present weather
+    stationplot.plot_symbol('W',data['wxcode'].values,current_weather)
+    # plot the wind barbs
+    stationplot.plot_barb(data['u'].values,data['v'].values,flip_barb=flip)
+    # plot the text of the station ID
+    stationplot.plot_text((2,0),data['siteID'])
+
+# renders one station plot tile (run in the tile worker processes)
+def renderStationTile(path,bounds,data,flip,fontsize):
+    fig,ax = tileFigure(bounds)
+    plotStations(ax,data,flip,fontsize)
+    saveTile(fig,path)
+
+# renders the station plot tiles for one domain, thinning the stations for each zoom level
+# (spacing is the minimum distance between stations on the tiles in pixels)
+def stationTiles(data,tiledir,zooms,spacing,extent,flip,fontsize,nprocs):
+    # thin in Web Mercator so the spacing matches what is seen on the tiles
+    point_locs = MERCATOR.transform_points(ccrs.PlateCarree(),data['lon'].values,data['lat'].values)
+    cols = ['siteID','lat','lon','temp','dpt','slp','cloud','wxcode','u','v']
+    jobs = {}
+    for zoom in zooms:
+        keep = reduce_point_density(point_locs,pixelsToMeters(spacing,zoom))
+        zdata = data[keep][cols]
+        mx = point_locs[keep,0]
+        my = point_locs[keep,1]
+        for tile in tilesForExtent(*extent,zoom):
+            bounds = tileBounds(*tile)
+            tiledata = zdata[pointsInTile(mx,my,bounds)]
+            tilehash = dataHash(tiledata,flip,fontsize) if len(tiledata) > 0 else None
+            jobs[tile] = (tilehash,(bounds,tiledata,flip,fontsize))
+    renderChanged(tiledir,jobs,renderStationTile,nprocs)
+
 def main():
     ### START OF USER SETTINGS BLOCK ###
 
@@ -76,6 +126,27 @@ def main():
     savedir = '/var/www/html/images/'
     # filenames for output
     savenames = ['conus.png','texas.png','atlantic.png']
+    # create the full-size maps above? (True/False)
+    make_png = True
+    # create Web Mercator tiles? (True/False): tiles go in tiledir/[savename without .png]/z/x/y.png
+    make_tiles = False
+    tiledir = '/var/www/html/tiles/'
+    # zoom levels to create tiles for
+    tilezooms = [4,5,6,7]
+    # minimum distance allowed between points on the tiles (in pixels, converted for each zoom level)
+    tilespacing = 80.0
+    # font size of the station plots on the tiles
+    tilefontsize = 8
+    # number of processes used to render tiles
+    nprocs = 4
+    # create an animated loop of each map? (True/False): saved in savedir as [savename]_loop.gif/.png/.mp4
+    makeloops = [True,False,False]
+    # working directory for the loop frames
+    loopdir = '/home/jgodwin/python/sfc_observations/loops/'
+    # number of frames (hours) in each loop
+    loopframes = 24
+    # loop formats ('gif', 'apng', and/or 'mp4', mp4 needs ffmpeg)
+    loopformats = ['gif','apng','mp4']
 
     # TEST MODE SETTINGS
     test = False    # True/False
@@ -107,6 +178,22 @@ def main():
         # filter data (there seems to be one site always reporting a really anomalous temperature
         data = data[data['temp'] <= 50]
 
+        ### DO SOME CONVERSIONS ###
+        # get the wind components
+        u,v = wind_components(data['wsp'].values*units('knots'),data['wdr'].values*units.degree)
+        data['u'] = u.m
+        data['v'] = v.m
+        # convert temperature from Celsius to Fahrenheit
+        data['temp'] = cToF(data['temp'])
+        data['dpt'] = cToF(data['dpt'])
+        # convert the cloud fraction value into a code of 0-8 (oktas) and compenate for NaN values
+        cloud_frac = (8 * data['sky'])
+        cloud_frac[np.isnan(cloud_frac)] = 10
+        data['cloud'] = cloud_frac.astype(int)
+        # map weather strings to WMO codes (only use first symbol if multiple are present
+        data['wx'] = data.wx.str.split('/').str[0] + ''
+        data['wxcode'] = [wx_code_map[s.split()[0] if ' ' in s else s] for s in data['wx'].fillna('')]
+
         print("Working on %s" % maps[i])
         # set up the map projection central longitude/latitude and the standard parallels
         cenlon = (west[i] + east[i]) / 2.0
@@ -118,6 +205,15 @@ def main():
         elif cenlat < 0:
             cutoff=30
             flip = True
+
+        # create the tiles (these do their own thinning for each zoom level)
+        if make_tiles:
+            print("\tCreating tiles.")
+            stationTiles(data,tiledir + savenames[i].replace('.png',''),tilezooms,tilespacing,\
+                (west[i],east[i],south[i],north[i]),flip,tilefontsize,nprocs)
+        if not make_png:
+            continue
+
         # create the projection
         if restart_projection:
             proj = ccrs.LambertConformal(central_longitude=cenlon,central_latitude=cenlat,standard_parallels=[sparallel],cutoff=cutoff)
@@ -131,19 +227,6 @@ def main():
             county_reader = shpreader.Reader(ctyshppath)
             counties = list(county_reader.geometries())
             COUNTIES = cfeature.ShapelyFeature(counties,ccrs.PlateCarree())
-        ### DO SOME CONVERSIONS ###
-        # get the wind components
-        u,v = wind_components(data['wsp'].values*units('knots'),data['wdr'].values*units.degree)
-        # convert temperature from Celsius to Fahrenheit
-        data['temp'] = cToF(data['temp'])
-        data['dpt'] = cToF(data['dpt'])
-        # convert the cloud fraction value into a code of 0-8 (oktas) and compenate for NaN values
-        cloud_frac = (8 * data['sky'])
-        cloud_frac[np.isnan(cloud_frac)] = 10
-        cloud_frac = cloud_frac.astype(int)
-        # map weather strings to WMO codes (only use first symbol if multiple are present
-        data['wx'] = data.wx.str.split('/').str[0] + ''
-        wx = [wx_code_map[s.split()[0] if ' ' in s else s] for s in data['wx'].fillna('')]
 
         # get the minimum and maximum temperatures in domain
         searchdata = data[(data['lat'] >= south[i]) & (data['lat'] <= north[i]) \
@@ -180,22 +263,7 @@ def main():
         ax.set_extent((west[i],east[i],south[i],north[i]))
 
         ### CREATE STATION PLOTS ###
-        # lat/lon of the station plots
-        stationplot = StationPlot(ax,data['lon'].values,data['lat'].values,clip_on=True,\
-            transform=ccrs.PlateCarree(),fontsize=6)
-        # plot the temperature and dewpoint
-        stationplot.plot_parameter('NW',data['temp'],color='red')
-        stationplot.plot_parameter('SW',data['dpt'],color='darkgreen')
-        # plot the SLP using the standard trailing three digits
-        stationplot.plot_parameter('NE',data['slp'],formatter=lambda v: format(10*v,'.0f')[-3:])
-        # plot the sky condition
-        stationplot.plot_symbol('C',cloud_frac,sky_cover)
-        # plot the present weather
-        stationplot.plot_symbol('W',wx,current_weather)
-        # plot the wind barbs
-        stationplot.plot_barb(u,v,flip_barb=flip)
-        # plot the text of the station ID
-        stationplot.plot_text((2,0),data['siteID'])
+        plotStations(ax,data,flip,6)
         # plot the valid time
         plt.title('Surface Observations valid %s' % vt)
         # plot the min/max temperature info and draw circle around warmest and coldest obs
@@ -210,6 +278,11 @@ def main():
         # save the figure
         outfile_name = savedir + savenames[i]
         plt.savefig(outfile_name,bbox_inches='tight')
+        # add the new map to the loop
+        if makeloops[i]:
+            print("\tUpdating loop.")
+            addFrame(loopdir,savenames[i].replace('.png',''),outfile_name,vt,nframes=loopframes,\
+                formats=loopformats,outdir=savedir)
 
         # clear and close everything
         fig.clear()
@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+''' Helpers for rendering the station plots (stationplots2.py) and objective analyses (objective.py)
+    as Web Mercator XYZ ("slippy map") tiles. Tiles are transparent 256x256 PNG overlays with no map
+    background, so they are meant to go on top of a base map in the web page (e.g. Leaflet or
+    OpenLayers using a {z}/{x}/{y}.png URL).
+
+    Each product directory keeps a manifest.json with a hash of the data that went into each tile,
+    so only the tiles whose data changed since the last cycle are re-rendered. Tiles are rendered in
+    parallel with multiprocessing.
+
+    Packages used: cartopy, matplotlib, numpy, pandas
+
+    Version History:
+    1.0 - Initial build.
+'''
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+
+import cartopy.crs as ccrs
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+__author__ = 'Jason Godwin'
+__license__ = 'GPL'
+__version__ = '1.0'
+__maintainer__ = 'Jason Godwin'
+__email__ = 'jasonwgodwin@gmail.com'
+__status__ = 'PRODUCTION'
+
+# Web Mercator projection used by slippy maps
+MERCATOR = ccrs.GOOGLE_MERCATOR
+# half the width of the Web Mercator world (meters)
+ORIGIN = 20037508.342789244
+# tile size (pixels)
+TILESIZE = 256
+# latitude limit of Web Mercator (degrees)
+MAXLAT = 85.0511
+
+# converts a longitude/latitude to the x/y number of the tile containing it at a zoom level
+def tileNumber(lon,lat,zoom):
+    n = 2 ** zoom
+    lat = max(min(lat,MAXLAT),-MAXLAT)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x,0),n-1),min(max(y,0),n-1)
+
+# returns the (west,east,south,north) bounds of a tile in Web Mercator meters
+def tileBounds(zoom,x,y):
+    size = 2.0 * ORIGIN / 2 ** zoom
+    west = -ORIGIN + x * size
+    north = ORIGIN - y * size
+    return (west,west+size,north-size,north)
+
+# converts a distance on a tile in pixels to Web Mercator meters at a zoom level
+def pixelsToMeters(pixels,zoom):
+    return pixels * 2.0 * ORIGIN / (TILESIZE * 2 ** zoom)
+
+# lists the (zoom,x,y) of every tile covering a longitude/latitude box
+def tilesForExtent(west,east,south,north,zoom):
+    x0,y0 = tileNumber(west,north,zoom)
+    x1,y1 = tileNumber(east,south,zoom)
+    return [(zoom,x,y) for x in range(x0,x1+1) for y in range(y0,y1+1)]
+
+# returns a mask of the points (in Web Mercator meters) within a tile
+# pad is the fraction of the tile width to extend each side by, so symbols drawn near the edge of
+# a tile also show up on the neighboring tile
+def pointsInTile(mx,my,bounds,pad=0.25):
+    west,east,south,north = bounds
+    buf = (east - west) * pad
+    return (mx >= west-buf) & (mx <= east+buf) & (my >= south-buf) & (my <= north+buf)
+
+# returns the (row,column) slices of a 2D grid (Web Mercator coordinates mx/my) needed to cover a
+# tile, or None if no part of the grid is in the tile
+def gridWindow(mx,my,bounds,pad=0.25):
+    mask = pointsInTile(mx,my,bounds,pad)
+    rows = np.where(mask.any(axis=1))[0]
+    cols = np.where(mask.any(axis=0))[0]
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    # add a cell on each side so the shading and contours run all the way across the tile
+    return (slice(max(rows[0]-1,0),rows[-1]+2),slice(max(cols[0]-1,0),cols[-1]+2))
+
+# hashes the data going into a tile (dataframes, arrays, or anything with a stable repr)
+def dataHash(*items):
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item,pd.DataFrame):
+            h.update(pd.util.hash_pandas_object(item,index=False).values.tobytes())
+            h.update(repr(list(item.columns)).encode())
+        elif isinstance(item,np.ndarray):
+            h.update(np.ascontiguousarray(np.ma.filled(item,np.nan)).tobytes())
+            h.update(repr(item.shape).encode())
+        else:
+            h.update(repr(item).encode())
+    return h.hexdigest()
+
+# creates a transparent, frameless figure covering exactly one tile
+def tileFigure(bounds):
+    dpi = 100
+    fig = plt.figure(figsize=(TILESIZE/dpi,TILESIZE/dpi),dpi=dpi)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0,0,1,1],projection=MERCATOR)
+    ax.set_extent(bounds,crs=MERCATOR)
+    ax.outline_patch.set_visible(False)
+    ax.background_patch.set_visible(False)
+    return fig,ax
+
+# saves and closes a tile figure
+def saveTile(fig,path):
+    fig.savefig(path,dpi=fig.dpi,transparent=True)
+    plt.close(fig)
+
+def loadManifest(tiledir):
+    try:
+        with open(os.path.join(tiledir,'manifest.json')) as f:
+            return json.load(f)
+    except (IOError,ValueError):
+        return {}
+
+def saveManifest(tiledir,manifest):
+    with open(os.path.join(tiledir,'manifest.json'),'w') as f:
+        json.dump(manifest,f)
+
+# renders the tiles whose data changed since the last cycle
+# jobs: {(zoom,x,y):(hash,args)} where hash is None for tiles with no data, and args are passed to
+#   render(path,*args), which must be a module-level function so it can be sent to the workers
+def renderChanged(tiledir,jobs,render,nprocs=4):
+    os.makedirs(tiledir,exist_ok=True)
+    manifest = loadManifest(tiledir)
+    tasks = []
+    for key,(tilehash,args) in jobs.items():
+        name = '%d/%d/%d' % key
+        path = os.path.join(tiledir,name + '.png')
+        # remove tiles that no longer have any data
+        if tilehash is None:
+            if name in manifest:
+                del manifest[name]
+                if os.path.exists(path):
+                    os.remove(path)
+            continue
+        if manifest.get(name) == tilehash and os.path.exists(path):
+            continue
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tasks.append(((path,) + tuple(args),name,tilehash))
+
+    print("\tRendering %d of %d tiles." % (len(tasks),len(jobs)))
+    if tasks:
+        with multiprocessing.Pool(nprocs) as pool:
+            pool.starmap(render,[t[0] for t in tasks])
+    # only record the new hashes once the tiles have actually been written
+    for _,name,tilehash in tasks:
+        manifest[name] = tilehash
+    saveManifest(tiledir,manifest)